@@ -20,7 +20,7 @@ resource "google_cloudfunctions2_function" "telegram_bot_function" {
     max_instance_count = 10
     min_instance_count = 0
     available_memory   = "384Mi"
-    timeout_seconds    = 60
+    timeout_seconds    = var.function_timeout
     service_account_email = google_service_account.function_sa.email
     secret_environment_variables {
       key        = "OPENAI_API_KEY"
@@ -50,6 +50,7 @@ resource "google_cloudfunctions2_function" "telegram_bot_function" {
       CONVERSATION_BUCKET = var.conversation_bucket
       GCP_PROJECT         = var.project
       GCP_REGION          = var.region
+      FUNCTION_TIMEOUT    = var.function_timeout
     }
   }
   depends_on = [
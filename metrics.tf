@@ -0,0 +1,18 @@
+# Метрика времени ожидания отправки сообщений в Telegram
+resource "google_logging_metric" "telegram_send_queue_delay" {
+  name   = "telegram_send_queue_delay_seconds"
+  filter = "resource.type=\"cloud_run_revision\" AND resource.labels.service_name=\"${google_cloudfunctions2_function.telegram_bot_function.name}\" AND textPayload:\"metric telegram_send_queue_delay_seconds=\""
+  metric_descriptor {
+    metric_kind = "DELTA"
+    value_type  = "DISTRIBUTION"
+    unit        = "s"
+  }
+  value_extractor = "REGEXP_EXTRACT(textPayload, \"telegram_send_queue_delay_seconds=([0-9.]+)\")"
+  bucket_options {
+    exponential_buckets {
+      num_finite_buckets = 16
+      growth_factor      = 2
+      scale              = 0.01
+    }
+  }
+}
@@ -11,7 +11,9 @@ resource "google_parameter_manager_regional_parameter_version" "allowed_models_v
       "openai": var.allowed_models_openai,
       "antropic": var.allowed_models_antropic,
       "xai": var.allowed_models_xai,
-      "google": var.allowed_models_google
+      "google": var.allowed_models_google,
+      "rate_limits": var.rate_limits,
+      "provider_context_reuse": var.provider_context_reuse
     }  
   )
 }
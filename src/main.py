@@ -7,17 +7,26 @@ import time
 import re
 import base64
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from functools import wraps
 import requests
 
-from openai import OpenAI
+import grpc
+from openai import OpenAI, BadRequestError, NotFoundError
 from anthropic import Anthropic
 from anthropic.types import TextBlock
 from loguru import logger
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import storage
 from google.cloud import parametermanager_v1
-from google.genai.types import Content, Part, UserContent, Image
+from google.genai.types import (
+    Content, Part, UserContent, Image, CreateCachedContentConfig, GenerateContentConfig,
+    GenerateImagesConfig
+)
 from google.genai import Client as Gemini
+from google.genai.errors import ClientError
 from xai_sdk import Client as Xai
 from xai_sdk.chat import user, assistant, image
 
@@ -28,13 +37,17 @@ from telegram.ext import (
     CommandHandler,
     CallbackQueryHandler,
 )
-from telegram import ParseMode, Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup, ChatAction
+from telegram.error import RetryAfter, TelegramError
+from telegram import (
+    ParseMode, Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup, ChatAction, InputMediaPhoto
+)
 
 # Telegram token
 TOKEN = os.environ.get("TELEGRAM_TOKEN")
 BUCKET_NAME = os.environ.get("CONVERSATION_BUCKET")
 GCP_REGION = os.environ.get("GCP_REGION")
 GCP_PROJECT = os.environ.get("GCP_PROJECT")
+FUNCTION_TIMEOUT = float(os.environ.get("FUNCTION_TIMEOUT", "60"))
 parameter_manager_client = parametermanager_v1.ParameterManagerClient(
     client_options={"api_endpoint": f"parametermanager.{GCP_REGION}.rep.googleapis.com"}
 )
@@ -49,6 +62,12 @@ allowed_models_google = allowed_models_json["google"]
 allowed_models_xai = allowed_models_json["xai"]
 allowed_models = (allowed_models_openai + allowed_models_antropic +
                   allowed_models_google + allowed_models_xai)
+# Хранить контекст разговора на стороне поставщика (OpenAI, xAI, Gemini)
+provider_context_reuse = bool(allowed_models_json.get("provider_context_reuse", False))
+# Время жизни кэша контекста Gemini совпадает с таймаутом сессии
+GEMINI_CACHE_TTL = "3600s"
+# Минимальный объём некэшированной истории (в символах) для создания кэша Gemini
+GEMINI_CACHE_MIN_CHARS = 16384
 # Telegram bot
 if TOKEN is not None:
     bot = Bot(token=TOKEN)
@@ -105,14 +124,16 @@ def load_s3_object(effective_user) -> dict:
     except Exception as e: #pylint: disable=W0718
         return {"statusCode": 400, "body": str(e)}
 
-def save_file(model, messages, effective_user) -> None | dict:
+def save_file(model, messages, effective_user, context=None) -> None | dict:
     """    
     Функция для сохранения истории сообщений в S3.
-    Сохраняет модель и сообщения в формате JSON.
+    Сохраняет модель, сообщения и состояние контекста у поставщика в формате JSON.
     """
     try:
         file_name = f'{effective_user}.json'
         content = {"model": model, "msgs": messages}
+        if context:
+            content["context"] = context
         bucket = storage_client.bucket(BUCKET_NAME)
         blob = bucket.blob(file_name)
         blob.upload_from_string(json.dumps(content),content_type='application/json')
@@ -125,10 +146,8 @@ def send_typing_action(func):
 
     @wraps(func)
     def command_func(update, context, *args, **kwargs):
-        context.bot.send_chat_action(
-            chat_id=update.effective_message.chat_id, action=ChatAction.TYPING
-        )
-        return func(update, context, *args, **kwargs)
+        with keep_chat_action(context.bot, update.effective_message.chat_id, ChatAction.TYPING):
+            return func(update, context, *args, **kwargs)
 
     return command_func
 
@@ -183,54 +202,641 @@ def split_markdown_message_safe(message: str, max_len: int = 4096) -> list:
 
     return chunks
 
-def load_models_and_msgs(effective_user) -> tuple:
+def load_chat_record(effective_user) -> tuple:
     """
-    Функция для загрузки модели и сообщений из S3.
-    Возвращает модель и список сообщений.
-    Если файл не существует, возвращает модель по умолчанию и пустой список сообщений.
+    Функция для загрузки модели, сообщений и состояния контекста у поставщика из S3.
+    Если файл не существует, возвращает модель по умолчанию, пустой список сообщений
+    и пустое состояние контекста.
     """
     if file_exists_in_s3(f'{effective_user}.json'):
         content = load_s3_object(effective_user)
         try:
             msgs = content["msgs"]
             model = content["model"]
+            context = content.get("context", {})
         except (KeyError, TypeError):
             model = "gpt-5-nano"
             msgs = content
+            context = {}
     else:
         msgs = []
         model = "gpt-5-nano"
+        context = {}
+    return model, msgs, context
+
+def load_models_and_msgs(effective_user) -> tuple:
+    """
+    Функция для загрузки модели и сообщений из S3.
+    Возвращает модель и список сообщений.
+    Если файл не существует, возвращает модель по умолчанию и пустой список сообщений.
+    """
+    model, msgs, _ = load_chat_record(effective_user)
     return model, msgs
 
-def ask_neural(text, effective_user) -> str:
-    """    
-    Функция для отправки запроса к нейросети и получения ответа.
-    Использует OpenAI или Anthropic в зависимости от модели.
+#################
+# Rate limiting #
+#################
+PRIORITY_COMMAND = "command"
+PRIORITY_LLM = "llm"
+
+DEFAULT_RATE_LIMITS = {
+    "backend": "memory",
+    "chat": {"rate": 0.2, "burst": 5},
+    "global": {"rate": 5.0, "burst": 30},
+    "providers": {
+        "openai": {"rate": 2.0, "burst": 10},
+        "antropic": {"rate": 1.0, "burst": 5},
+        "google": {"rate": 2.0, "burst": 10},
+        "xai": {"rate": 1.0, "burst": 5},
+    },
+    "max_wait": {PRIORITY_COMMAND: 5.0, PRIORITY_LLM: 2.0},
+    "command_reserve": 1,
+}
+
+class RateLimitExceeded(Exception):
+    """
+    Исключение, выбрасываемое при превышении лимита запросов.
+    Содержит время в секундах, через которое запрос можно повторить.
+    """
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded for {scope}, retry after {retry_after:.1f}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+def take_token(state, rate, burst, now, reserve=0, refund=False, cost=1) -> tuple:
+    """
+    Пополняет корзину токенов на момент now и пытается списать cost токенов.
+    Токены списываются, только если после списания в корзине останется не меньше reserve.
+    Возвращает новое состояние корзины и время ожидания (0.0, если токены списаны).
+    """
+    if state is None:
+        tokens, updated = float(burst), now
+    else:
+        tokens, updated = state["tokens"], state["updated"]
+    tokens = min(float(burst), tokens + max(0.0, now - updated) * rate)
+    if refund:
+        return {"tokens": min(float(burst), tokens + cost), "updated": now}, 0.0
+    if tokens >= cost + reserve:
+        return {"tokens": tokens - cost, "updated": now}, 0.0
+    return {"tokens": tokens, "updated": now}, (cost + reserve - tokens) / rate
+
+def provider_costs(providers) -> dict:
+    """
+    Приводит поставщиков обработки к словарю {поставщик: число запросов к нему}.
+    """
+    if providers is None:
+        return {}
+    if isinstance(providers, str):
+        return {providers: 1}
+    return dict(providers)
+
+class MemoryBucketStore:
+    """
+    Хранилище состояния корзин токенов в памяти инстанса функции.
+    """
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def update(self, key, func):
+        """
+        Применяет func к состоянию корзины key и сохраняет новое состояние.
+        """
+        with self._lock:
+            state, result = func(self._buckets.get(key))
+            self._buckets[key] = state
+            return result
+
+class GcsBucketStore:
+    """
+    Общее для всех инстансов хранилище состояния корзин токенов в GCS.
+    Атомарность обновления обеспечивается условием if_generation_match.
+    """
+    def __init__(self, bucket_name, prefix="ratelimit/", attempts=5):
+        self._bucket_name = bucket_name
+        self._prefix = prefix
+        self._attempts = attempts
+
+    def update(self, key, func):
+        """
+        Применяет func к состоянию корзины key и сохраняет новое состояние,
+        повторяя попытку при конкурентном изменении объекта.
+        """
+        blob = storage_client.bucket(self._bucket_name).blob(f"{self._prefix}{key}.json")
+        for _ in range(self._attempts):
+            try:
+                try:
+                    # Поколение объекта берётся из ответа на то же скачивание
+                    state = json.loads(blob.download_as_bytes())
+                    generation = blob.generation
+                except NotFound:
+                    generation, state = 0, None
+                new_state, result = func(state)
+                blob.upload_from_string(json.dumps(new_state),
+                                        content_type='application/json',
+                                        if_generation_match=generation)
+                return result
+            except PreconditionFailed:
+                continue
+        raise RuntimeError(f"Failed to update rate limit bucket {key}")
+
+class RateLimiter:
+    """
+    Ограничитель частоты запросов на основе корзин токенов:
+    на чат, на поставщика моделей и общий на весь бот.
+    Запросы с приоритетом PRIORITY_LLM не могут занять последние command_reserve
+    токенов, поэтому команды обслуживаются раньше обращений к нейросетям.
+    Если токена нет, запрос ожидает не дольше max_wait для своего приоритета,
+    иначе выбрасывается RateLimitExceeded.
+    В store хранятся только корзины чатов. Корзины поставщиков и общая корзина
+    обновляются на каждый запрос, поэтому всегда хранятся в памяти инстанса:
+    GCS допускает около одной записи в секунду в один объект.
+    """
+    def __init__(self, limits, store=None, clock=time.time, sleep=time.sleep):
+        self.limits = limits
+        self.store = store or MemoryBucketStore()
+        self.local_store = MemoryBucketStore()
+        self.clock = clock
+        self.sleep = sleep
+        self._fallback_logged = False
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """
+        Создаёт ограничитель из секции rate_limits параметра allowed_models.
+        Незаданные значения берутся из DEFAULT_RATE_LIMITS.
+        """
+        limits = {**DEFAULT_RATE_LIMITS, **(config or {})}
+        limits["providers"] = {**DEFAULT_RATE_LIMITS["providers"],
+                               **(config or {}).get("providers", {})}
+        limits["max_wait"] = {**DEFAULT_RATE_LIMITS["max_wait"],
+                              **(config or {}).get("max_wait", {})}
+        if limits["backend"] == "gcs" and BUCKET_NAME:
+            store = GcsBucketStore(BUCKET_NAME)
+        else:
+            store = MemoryBucketStore()
+        return cls(limits, store, **kwargs)
+
+    def _buckets(self, chat_id, providers) -> list:
+        """
+        Возвращает корзины запроса с их стоимостью: корзины чата и бота списываются
+        один раз на обработку, корзина поставщика - по числу запросов к нему.
+        """
+        buckets = [(f"chat-{chat_id}", self.limits["chat"], 1)]
+        for provider, cost in provider_costs(providers).items():
+            if provider in self.limits["providers"]:
+                buckets.append((f"provider-{provider}", self.limits["providers"][provider], cost))
+        buckets.append(("global", self.limits["global"], 1))
+        # Корзины с нулевой скоростью пополнения считаются отключёнными
+        return [(key, limit, cost) for key, limit, cost in buckets
+                if limit and limit["rate"] > 0]
+
+    def _update(self, key, func):
+        if not key.startswith("chat-"):
+            return self.local_store.update(key, func)
+        try:
+            return self.store.update(key, func)
+        except Exception as e: #pylint: disable=W0718
+            if not self._fallback_logged:
+                # Лимиты чатов перестают быть общими для инстансов
+                logger.error(f"Rate limit store unavailable, using memory: {str(e)}")
+                self._fallback_logged = True
+            else:
+                logger.warning(f"Rate limit store unavailable, using memory: {str(e)}")
+            return self.local_store.update(key, func)
+
+    def _refund(self, taken) -> None:
+        for key, limit, cost in taken:
+            self._update(key, lambda state, limit=limit, cost=cost:
+                         take_token(state, limit["rate"], limit["burst"],
+                                    self.clock(), refund=True, cost=cost))
+
+    def admit(self, chat_id, providers=None, priority=PRIORITY_LLM) -> None:
+        """
+        Списывает по токену из корзин чата и бота и токены из корзин поставщиков.
+        providers - имя поставщика или словарь {поставщик: число запросов к нему}.
+        Выбрасывает RateLimitExceeded, если дождаться токенов не удалось;
+        уже списанные токены при этом возвращаются.
+        """
+        reserve = self.limits["command_reserve"] if priority == PRIORITY_LLM else 0
+        max_wait = self.limits["max_wait"].get(priority, 0.0)
+        started = self.clock()
+        taken = []
+        for key, limit, cost in self._buckets(chat_id, providers):
+            bucket_reserve = 0 if key.startswith("provider-") else reserve
+            if cost + bucket_reserve > limit["burst"]:
+                # Столько токенов корзина не накопит никогда
+                self._refund(taken)
+                raise RateLimitExceeded(key, cost / limit["rate"])
+            while True:
+                wait = self._update(key, lambda state, limit=limit, r=bucket_reserve, c=cost:
+                                    take_token(state, limit["rate"], limit["burst"],
+                                               self.clock(), reserve=r, cost=c))
+                if wait == 0.0:
+                    taken.append((key, limit, cost))
+                    break
+                if self.clock() - started + wait > max_wait:
+                    self._refund(taken)
+                    raise RateLimitExceeded(key, wait)
+                self.sleep(wait)
+
+    def refund(self, chat_id, providers=None) -> None:
+        """
+        Возвращает токены, списанные admit, если запрос так и не был выполнен.
+        """
+        self._refund(self._buckets(chat_id, providers))
+
+rate_limiter = RateLimiter.from_config(allowed_models_json.get("rate_limits"))
+
+def model_provider(model) -> str | None:
+    """
+    Возвращает поставщика модели в терминах параметра allowed_models.
+    """
+    for provider, models in (("openai", allowed_models_openai),
+                             ("antropic", allowed_models_antropic),
+                             ("google", allowed_models_google),
+                             ("xai", allowed_models_xai)):
+        if model in models:
+            return provider
+    return None
+
+def rate_limit_message(error) -> str:
+    """
+    Формирует сообщение пользователю об отклонённом из-за нагрузки запросе.
+    """
+    return f"Слишком много запросов, попробуйте через {max(1, round(error.retry_after))} сек."
+
+def rate_limited(func):
+    """Admits command into rate limiter before processing func command."""
+
+    @wraps(func)
+    def command_func(update, context, *args, **kwargs):
+        chat_id = update.effective_chat.id
+        try:
+            rate_limiter.admit(chat_id, priority=PRIORITY_COMMAND)
+        except RateLimitExceeded as e:
+            logger.warning(f"Command shed for chat {chat_id}: {str(e)}")
+            send_scheduler.send_message(context.bot, chat_id=chat_id, text=rate_limit_message(e))
+            return None
+        return func(update, context, *args, **kwargs)
+
+    return command_func
+
+###########################
+# Telegram send scheduler #
+###########################
+# Ограничения Telegram: около 1 сообщения в секунду в личный чат,
+# 20 сообщений в минуту в группу и 30 сообщений в секунду на бота
+DEFAULT_SEND_LIMITS = {
+    "chat": {"rate": 1.0, "burst": 3},
+    "group": {"rate": 20 / 60, "burst": 3},
+    "global": {"rate": 30.0, "burst": 30},
+}
+# Telegram показывает chat action около 5 секунд
+CHAT_ACTION_INTERVAL = 4.5
+# Время на обработку одного обновления: таймаут функции минус запас на ответ вебхуку
+# (10%, но не меньше 5 секунд). Если функция не успеет ответить, Telegram
+# повторит обновление и ответ будет сгенерирован и отправлен ещё раз.
+REQUEST_TIMEOUT = FUNCTION_TIMEOUT - max(5.0, FUNCTION_TIMEOUT * 0.1)
+
+class SendScheduler:
+    """
+    Планировщик исходящих сообщений Telegram.
+    Соблюдает ограничения частоты отправки на чат и на бота с помощью корзин токенов,
+    повторяет отправку после RetryAfter и пишет в лог время ожидания в очереди.
+    Ожидания не выходят за срок обработки текущего обновления (start_request):
+    если отправить сообщение до него нельзя, отправка отменяется.
+    """
+    def __init__(self, limits=None, clock=time.monotonic, sleep=time.sleep, max_retries=3):
+        self.limits = limits or DEFAULT_SEND_LIMITS
+        self.store = MemoryBucketStore()
+        self.clock = clock
+        self.sleep = sleep
+        self.max_retries = max_retries
+        self.deadline = None
+
+    def start_request(self, timeout) -> None:
+        """
+        Задаёт срок, до которого должна завершиться отправка ответов на текущее обновление.
+        """
+        self.deadline = self.clock() + timeout
+
+    def _fits_deadline(self, delay) -> bool:
+        return self.deadline is None or self.clock() + delay <= self.deadline
+
+    def _take(self, key, limit, refund=False) -> float:
+        return self.store.update(key, lambda state: take_token(
+            state, limit["rate"], limit["burst"], self.clock(), refund=refund))
+
+    def _acquire(self, chat_id, wait=True, per_chat=True) -> float | None:
+        """
+        Списывает токены из корзины бота и, если per_chat, из корзины чата.
+        Возвращает время ожидания в секундах или None, если токенов нет,
+        а ждать нельзя (wait=False) или ожидание выходит за срок обработки.
+        """
+        started = self.clock()
+        buckets = [("global", self.limits["global"])]
+        if per_chat:
+            chat_limit = self.limits["group"] if int(chat_id) < 0 else self.limits["chat"]
+            buckets.insert(0, (f"chat-{chat_id}", chat_limit))
+        taken = []
+        for key, limit in buckets:
+            while True:
+                delay = self._take(key, limit)
+                if delay == 0.0:
+                    taken.append((key, limit))
+                    break
+                if not wait or not self._fits_deadline(delay):
+                    for taken_key, taken_limit in taken:
+                        self._take(taken_key, taken_limit, refund=True)
+                    return None
+                self.sleep(delay)
+        return self.clock() - started
+
+    def _send(self, send, chat_id, **kwargs):
+        """
+        Вызывает метод отправки Telegram с учётом ограничений.
+        При RetryAfter ждёт указанное Telegram время и повторяет отправку.
+        Возвращает None, если до срока обработки отправить сообщение не удалось.
+        """
+        queued = 0.0
+        for attempt in range(self.max_retries + 1):
+            delay = self._acquire(chat_id)
+            if delay is None:
+                logger.error(f"Send to chat {chat_id} dropped: rate limit wait exceeds deadline")
+                return None
+            queued += delay
+            try:
+                message = send(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                if not self._fits_deadline(e.retry_after):
+                    logger.error(f"Send to chat {chat_id} dropped: "
+                                 f"retry after {e.retry_after}s exceeds deadline")
+                    return None
+                logger.warning(f"Telegram flood control for chat {chat_id}, "
+                               f"retry after {e.retry_after}s")
+                self.sleep(e.retry_after)
+                queued += e.retry_after
+            else:
+                logger.info(f"metric telegram_send_queue_delay_seconds={queued:.3f} "
+                            f"chat_id={chat_id}")
+                return message
+        return None
+
+    def send_message(self, bot, chat_id, text, **kwargs):
+        """
+        Отправляет сообщение с учётом ограничений Telegram.
+        """
+        return self._send(bot.send_message, chat_id, text=text, **kwargs)
+
+    def send_photo(self, bot, chat_id, photo, **kwargs):
+        """
+        Отправляет изображение с учётом ограничений Telegram.
+        """
+        return self._send(bot.send_photo, chat_id, photo=photo, **kwargs)
+
+    def send_media_group(self, bot, chat_id, media, **kwargs):
+        """
+        Отправляет группу изображений одним сообщением с учётом ограничений Telegram.
+        """
+        return self._send(bot.send_media_group, chat_id, media=media, **kwargs)
+
+    def send_voice(self, bot, chat_id, voice, **kwargs):
+        """
+        Отправляет голосовое сообщение с учётом ограничений Telegram.
+        """
+        return self._send(bot.send_voice, chat_id, voice=voice, **kwargs)
+
+    def send_chunks(self, bot, chat_id, chunks, **kwargs) -> None:
+        """
+        Отправляет части длинного сообщения по порядку.
+        Если часть отправить не удалось, остальные части не отправляются.
+        """
+        for chunk in chunks:
+            if self.send_message(bot, chat_id, chunk, **kwargs) is None:
+                return
+
+    def send_chat_action(self, bot, chat_id, action) -> None:
+        """
+        Отправляет chat action, только если это не превышает общее ограничение бота.
+        Ошибки отправки не прерывают обработку сообщения.
+        """
+        if self._acquire(chat_id, wait=False, per_chat=False) is None:
+            return
+        try:
+            bot.send_chat_action(chat_id=chat_id, action=action)
+        except TelegramError as e:
+            logger.warning(f"Error sending chat action to chat {chat_id}: {str(e)}")
+
+send_scheduler = SendScheduler()
+
+@contextmanager
+def keep_chat_action(bot, chat_id, action):
+    """
+    Показывает chat action в чате, пока выполняется тело блока with.
+    """
+    done = threading.Event()
+
+    def refresh():
+        while not done.is_set():
+            send_scheduler.send_chat_action(bot, chat_id, action)
+            done.wait(CHAT_ACTION_INTERVAL)
+
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        done.set()
+        thread.join()
+
+# Задачи, которые выполняются после отправки ответа пользователю
+DEFERRED_TASKS = []
+
+def defer(func, *args) -> None:
+    """
+    Откладывает вызов func до окончания обработки сообщения,
+    чтобы служебные запросы к поставщикам не задерживали ответ.
+    """
+    DEFERRED_TASKS.append((func, args))
+
+def run_deferred() -> None:
+    """
+    Выполняет отложенные задачи. Ошибка одной задачи не мешает остальным.
+    """
+    while DEFERRED_TASKS:
+        func, args = DEFERRED_TASKS.pop(0)
+        try:
+            func(*args)
+        except Exception as e: #pylint: disable=W0718
+            logger.error(f"Error in deferred task {func.__name__}: {str(e)}")
+
+def message_text(content) -> str:
+    """
+    Возвращает текст сообщения из истории.
+    Мультимодальные сообщения хранятся списком блоков, из них берутся только текстовые.
+    """
+    if isinstance(content, list):
+        return "\n".join(block["text"] for block in content if "text" in block)
+    return content
+
+def openai_input(msgs) -> list:
+    """
+    Формирует input для OpenAI Responses API из истории сообщений.
     """
-    model, msgs = load_models_and_msgs(effective_user)
     history = []
-    if model in allowed_models_openai:
-        msgs.append({"role": "user", "content": text})
-        for msg in msgs:
-            if msg["role"]=="user":
-                history.append({"role": "user",
-                                "content":[{"type": "input_text", "text": msg["content"]}]})
+    for msg in msgs:
+        if msg["role"]=="user":
+            history.append({"role": "user",
+                            "content":[{"type": "input_text",
+                                        "text": message_text(msg["content"])}]})
+        else:
             history.append({"role": "assistant",
-                            "content":[{"type": "output_text","text": msg["content"]}]})
-        chat = client.responses.create( #pylint: disable=E0606
+                            "content":[{"type": "output_text",
+                                        "text": message_text(msg["content"])}]})
+    return history
+
+def anthropic_messages(msgs) -> list:
+    """
+    Формирует сообщения для Anthropic с точкой кэширования (cache_control) на последнем
+    сообщении, чтобы вся отправленная история стала кэшированным префиксом следующего запроса.
+    История в S3 остаётся без cache_control.
+    """
+    messages = list(msgs)
+    if messages:
+        content = messages[-1]["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        else:
+            content = [dict(block) for block in content]
+        content[-1]["cache_control"] = {"type": "ephemeral"}
+        messages[-1] = {**messages[-1], "content": content}
+    return messages
+
+def gemini_contents(msgs) -> list:
+    """
+    Формирует contents для Gemini из истории сообщений.
+    """
+    history = []
+    for msg in msgs:
+        if msg["role"]=="user":
+            history.append(UserContent(parts=[Part(text=message_text(msg["content"]))]))
+        else:
+            history.append(Content(parts=[Part(text=message_text(msg["content"]))],role="model"))
+    return history
+
+def xai_messages(msgs) -> list:
+    """
+    Формирует сообщения для xAI из истории сообщений.
+    """
+    history = []
+    for msg in msgs:
+        if msg["role"]=="user":
+            history.append(user(message_text(msg["content"])))
+        else:
+            history.append(assistant(message_text(msg["content"])))
+    return history
+
+def refresh_gemini_cache(model, msgs, cache) -> dict | None:
+    """
+    Создаёт новый кэш контекста Gemini для всей истории, если некэшированная часть
+    истории стала достаточно большой. Предыдущий кэш при этом удаляется.
+    Возвращает описание актуального кэша: имя и количество закэшированных сообщений.
+    """
+    start = cache["count"] if cache else 0
+    if sum(len(message_text(msg["content"])) for msg in msgs[start:]) < GEMINI_CACHE_MIN_CHARS:
+        return cache
+    try:
+        created = client_googleai.caches.create( #pylint: disable=E0606
             model=model,
-            input=history,
+            config=CreateCachedContentConfig(contents=gemini_contents(msgs), ttl=GEMINI_CACHE_TTL),
         )
+    except ClientError as e:
+        logger.warning(f"Error creating Gemini context cache: {str(e)}")
+        return cache
+    delete_gemini_cache(cache)
+    return {"name": created.name, "count": len(msgs)}
+
+def delete_gemini_cache(cache) -> None:
+    """
+    Удаляет кэш контекста Gemini, который больше не используется,
+    чтобы не платить за его хранение до истечения TTL.
+    """
+    if not cache:
+        return
+    try:
+        client_googleai.caches.delete(name=cache["name"]) #pylint: disable=E0606
+    except ClientError as e:
+        logger.warning(f"Error deleting Gemini context cache: {str(e)}")
+
+def update_gemini_cache(effective_user) -> None:
+    """
+    Обновляет кэш контекста Gemini по сохранённой истории чата.
+    Вызывается после отправки ответа, поэтому создание кэша не задерживает ответ.
+    """
+    model, msgs, context = load_chat_record(effective_user)
+    if model not in allowed_models_google or context.get("model") != model:
+        return
+    cache = refresh_gemini_cache(model, msgs, context.get("cache"))
+    if cache != context.get("cache"):
+        save_file(model, msgs, effective_user, {"model": model, "cache": cache})
+
+def save_without_context(model, msgs, effective_user, context) -> None:
+    """
+    Сохраняет историю без контекста у поставщика и удаляет кэш Gemini,
+    на который ссылался прежний контекст.
+    """
+    save_file(model, msgs, effective_user)
+    defer(delete_gemini_cache, context.get("cache"))
+
+def ask_neural(text, effective_user, admit=True) -> str:
+    """
+    Функция для отправки запроса к нейросети и получения ответа.
+    Использует OpenAI, Anthropic, Google или xAI в зависимости от модели.
+    Если включено provider_context_reuse, вместо полной истории отправляет
+    только новое сообщение со ссылкой на контекст, сохранённый у поставщика.
+    admit=False означает, что вызывающий код уже прошёл ограничитель частоты запросов.
+    """
+    model, msgs, context = load_chat_record(effective_user)
+    if admit:
+        rate_limiter.admit(effective_user, model_provider(model))
+    # Контекст у поставщика действителен только для модели, с которой он создан
+    if not provider_context_reuse or context.get("model") != model:
+        defer(delete_gemini_cache, context.get("cache"))
+        context = {}
+    msgs.append({"role": "user", "content": text})
+    if model in allowed_models_openai:
+        chat = None
+        if context.get("response_id"):
+            try:
+                chat = client.responses.create( #pylint: disable=E0606
+                    model=model,
+                    input=openai_input(msgs[-1:]),
+                    previous_response_id=context["response_id"],
+                )
+            except (BadRequestError, NotFoundError) as e:
+                # Полная история отправляется повторно, только если ссылка устарела
+                if isinstance(e, BadRequestError) and e.param != "previous_response_id":
+                    raise
+                logger.warning(f"Previous OpenAI response is unavailable: {str(e)}")
+        if chat is None:
+            chat = client.responses.create(
+                model=model,
+                input=openai_input(msgs),
+            )
         #logger.info(f"Response: {chat}")
         msgs.append({"role": "assistant", "content": chat.output_text})
-        save_file(model, msgs, effective_user)
+        if provider_context_reuse:
+            context = {"model": model, "response_id": chat.id}
+        save_file(model, msgs, effective_user, context)
         return str(chat.output_text)
     if model in allowed_models_antropic:
-        msgs.append({"role": "user", "content": text})
         chat = client_anthropic.messages.create( #pylint: disable=E0606
             model=model,
             max_tokens=8192,
-            messages=msgs
+            messages=anthropic_messages(msgs)
         )
         if isinstance(chat.content[0], TextBlock):
             answer = chat.content[0].text
@@ -240,36 +846,66 @@ def ask_neural(text, effective_user) -> str:
             answer = ""
         return answer
     if model in allowed_models_google:
-        for msg in msgs:
-            if msg["role"]=="user":
-                history.append(UserContent(parts=[Part(text=msg["content"])]))
-            history.append(Content(parts=[Part(text=msg["content"])],role="model"))
-        msgs.append({"role": "user", "content": text})
-        chat = client_googleai.chats.create( #pylint: disable=E0606
-            model=model,
-            history=history)
-        response = chat.send_message(text)
+        response = None
+        cache = context.get("cache")
+        if cache:
+            try:
+                response = client_googleai.models.generate_content( #pylint: disable=E0606
+                    model=model,
+                    contents=gemini_contents(msgs[cache["count"]:]),
+                    config=GenerateContentConfig(cached_content=cache["name"]),
+                )
+            except ClientError as e:
+                if e.code != 404:
+                    raise
+                logger.warning(f"Gemini context cache is unavailable: {str(e)}")
+                cache = None
+        if response is None:
+            response = client_googleai.models.generate_content(
+                model=model,
+                contents=gemini_contents(msgs),
+            )
         msgs.append({"role": "assistant", "content": response.text})
-        save_file(model, msgs, effective_user)
+        if provider_context_reuse:
+            context = {"model": model, "cache": cache}
+            # Новый кэш создаётся уже после отправки ответа
+            defer(update_gemini_cache, effective_user)
+        save_file(model, msgs, effective_user, context)
         return str(response.text)
     if model in allowed_models_xai:
-        msgs.append({"role": "user", "content": text})
-        for msg in msgs:
-            if msg["role"]=="user":
-                history.append(user(msg["content"]))
-            history.append(assistant(msg["content"]))
-        chat = client_xai.chat.create( #pylint: disable=E0606
-            model=model,
-            messages=history
-        )
-        response = chat.sample()
+        response = None
+        if context.get("response_id"):
+            try:
+                chat = client_xai.chat.create( #pylint: disable=E0606
+                    model=model,
+                    messages=xai_messages(msgs[-1:]),
+                    previous_response_id=context["response_id"],
+                    store_messages=True,
+                )
+                response = chat.sample()
+            except grpc.RpcError as e:
+                if e.code() not in (grpc.StatusCode.NOT_FOUND, # pylint: disable=E1101
+                                    grpc.StatusCode.INVALID_ARGUMENT):
+                    raise
+                logger.warning(f"Previous xAI response is unavailable: {str(e)}")
+        if response is None:
+            chat = client_xai.chat.create(
+                model=model,
+                messages=xai_messages(msgs),
+                store_messages=provider_context_reuse,
+            )
+            response = chat.sample()
         msgs.append({"role": "assistant", "content": response.content})
+        if provider_context_reuse:
+            context = {"model": model, "response_id": response.id}
+        save_file(model, msgs, effective_user, context)
         return str(response.content)
     return ""
 
 #####################
 # Telegram Handlers #
 #####################
+@rate_limited
 @send_typing_action
 def clear_context(update, context):
     """    
@@ -280,26 +916,30 @@ def clear_context(update, context):
         effective_user = update.message.chat_id
     except AttributeError:
         effective_user = update.callback_query.message.chat.id
-    model, _ = load_models_and_msgs(effective_user)
-    save_file(model,[],effective_user)
-    context.bot.send_message(
+    model, _, chat_context = load_chat_record(effective_user)
+    save_without_context(model, [], effective_user, chat_context)
+    send_scheduler.send_message(
+        context.bot,
         chat_id=effective_user,
         text="Начата новая сессия",
         parse_mode=ParseMode.MARKDOWN,
     )
 
+@rate_limited
 @send_typing_action
 def send_greeting(update, context):
     """
     Функция для отправки приветственного сообщения пользователю.
     """
     message = f'''Привет {update.effective_user.first_name}!'''
-    context.bot.send_message(
+    send_scheduler.send_message(
+        context.bot,
         chat_id=update.message.chat_id,
         text=message,
         parse_mode=ParseMode.MARKDOWN,
     )
 
+@rate_limited
 @send_typing_action
 def send_help(update, context):
     """
@@ -307,12 +947,14 @@ def send_help(update, context):
     """
     message = f'''Привет {update.effective_user.first_name}!
                 Я бот созданный для тестирование Lambda функций и отправки запросов в chatGPT.'''
-    context.bot.send_message(
+    send_scheduler.send_message(
+        context.bot,
         chat_id=update.message.chat_id,
         text=message,
         parse_mode=ParseMode.MARKDOWN,
     )
 
+@rate_limited
 @send_typing_action
 def set_model(update, context):
     """
@@ -325,15 +967,17 @@ def set_model(update, context):
     except IndexError:
         model = ""
     if model in allowed_models:
-        _, msgs = load_models_and_msgs(effective_user)
-        save_file(model, msgs, effective_user)
-        context.bot.send_message(
+        _, msgs, chat_context = load_chat_record(effective_user)
+        save_without_context(model, msgs, effective_user, chat_context)
+        send_scheduler.send_message(
+            context.bot,
             chat_id=update.message.chat_id,
             text=f'Сохранено в настройки использование модели {model}',
             parse_mode=ParseMode.MARKDOWN,
         )
     else:
-        context.bot.send_message(
+        send_scheduler.send_message(
+            context.bot,
             chat_id=update.message.chat_id,
             text='Доступные модели ' + ', '.join(allowed_models),
             parse_mode=ParseMode.MARKDOWN,
@@ -353,9 +997,13 @@ def button(update, context) -> None:
         chat_text = context.user_data.get('previous_message_text')
         chat_id = update.callback_query.message.chat.id
         try:
-            message = ask_neural(chat_text, chat_id)
+            with keep_chat_action(context.bot, chat_id, ChatAction.TYPING):
+                message = ask_neural(chat_text, chat_id)
+        except RateLimitExceeded as e:
+            send_scheduler.send_message(context.bot, chat_id=chat_id, text=rate_limit_message(e))
         except Exception as e: #pylint: disable=W0718
-            context.bot.send_message(
+            send_scheduler.send_message(
+                context.bot,
                 chat_id=chat_id,
                 text=f"Ошибка при обработке сообщения: `{str(e)}`",
                 parse_mode=ParseMode.MARKDOWN,
@@ -363,13 +1011,14 @@ def button(update, context) -> None:
         else:
             chunks = split_markdown_message_safe(message)
             #logger.info(f"Response: {chunks}")
-            for chunk in chunks:
-                context.bot.send_message(
-                    chat_id=chat_id,
-                    text=chunk,
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
+            send_scheduler.send_chunks(
+                context.bot,
+                chat_id=chat_id,
+                chunks=chunks,
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
 
+@rate_limited
 @send_typing_action
 def get_model(update, context):
     """
@@ -378,80 +1027,185 @@ def get_model(update, context):
     """
     effective_user = update.message.chat_id
     model, _ = load_models_and_msgs(effective_user)
-    context.bot.send_message(
+    send_scheduler.send_message(
+        context.bot,
         chat_id=update.message.chat_id,
         text=f'Считано из настроек использование модели {model}',
         parse_mode=ParseMode.MARKDOWN,
     )
 
-@send_typing_action
-def generate_image(update, context):
+# Модели генерации изображений: поставщик и максимум изображений в одном запросе
+IMAGE_MODELS = {
+    "dall-e-2": ("openai", 10),
+    "dall-e-3": ("openai", 1),
+    "imagen-4.0-generate-001": ("google", 4),
+    "grok-2-image": ("xai", 10),
+}
+# Telegram допускает не более 10 изображений в одной группе
+MEDIA_GROUP_MAX = 10
+# Максимальная длина подписи к изображению в Telegram
+CAPTION_MAX = 1024
+
+def parse_image_command(text) -> tuple:
     """
-    Функция для генерации изображения по текстовому запросу.
-    Если в запросе указана модель, использует её, иначе использует модель по умолчанию.
-    Отправляет сгенерированное изображение пользователю.
+    Разбирает аргументы команды /image: параметры n:<количество> и model:<модель>[,<модель>...]
+    перед промптом. Возвращает список моделей, количество изображений на модель и промпт.
     """
-    text = update.message.text[7:]
-    if text.find("model:")!=-1:
-        match = re.search(r'model\:([^\s]+)\s(.+)', text)
-        if match is not None:
-            model = match.group(1)
-            prompt = match.group(2)
+    models = []
+    count = 1
+    while True:
+        match = re.match(r'\s*(?:model:(\S+)|n:(\d+))(?:\s+|$)', text)
+        if match is None:
+            break
+        if match.group(1) is not None:
+            models += [model for model in match.group(1).split(",") if model]
         else:
-            return
-    else:
-        model = "dall-e-2"
-        prompt = text
-    if bool(prompt):
-        if model in ["dall-e-2", "dall-e-3"]:
-            response = client.images.generate(
-                model=model,
-                prompt=prompt,
-            )
-            if response.data is not None:
-                context.bot.send_photo(chat_id=update.effective_chat.id,
-                                    photo=response.data[0].url,
-                                    caption=response.data[0].revised_prompt
-                                    )
-            return
-        if model in ["imagen-4.0-generate-001"]:
-            response = client_googleai.models.generate_images(
-                model="imagen-4.0-generate-001",
-                prompt=prompt,
-            )
-            if response.generated_images is not None:
-                if isinstance(response.generated_images[0].image, Image):
-                    context.bot.send_photo(chat_id=update.effective_chat.id,
-                        photo=response.generated_images[0].image.image_bytes,
-                    )
-                    return
-            logger.error("Error generate image from Google")
-            return
-        if model in ["grok-2-image"]:
-            response = client_xai.image.sample(
-                model=model,
-                prompt=prompt,
-            )
-            if response.url is not None:
-                context.bot.send_photo(chat_id=update.effective_chat.id,
-                                    photo=response.url,
-                                    caption=response.prompt
-                                    )
-            return
-        context.bot.send_message(
-            chat_id=update.effective_chat.id,
+            count = int(match.group(2))
+        text = text[match.end():]
+    return models or ["dall-e-2"], count, text.strip()
+
+def image_tasks(models, count) -> list:
+    """
+    Разбивает генерацию count изображений каждой моделью на запросы
+    с учётом максимального количества изображений в одном запросе.
+    """
+    tasks = []
+    for model in models:
+        _, max_n = IMAGE_MODELS[model]
+        remaining = count
+        while remaining > 0:
+            tasks.append((model, min(remaining, max_n)))
+            remaining -= max_n
+    return tasks
+
+def generate_images(model, prompt, n) -> list:
+    """
+    Генерирует n изображений выбранной моделью.
+    Возвращает список пар (байты изображения, подпись) без повторной загрузки по URL.
+    """
+    provider, _ = IMAGE_MODELS[model]
+    if provider == "openai":
+        response = client.images.generate( #pylint: disable=E0606
+            model=model,
+            prompt=prompt,
+            n=n,
+            response_format="b64_json",
+        )
+        return [(base64.b64decode(item.b64_json), item.revised_prompt)
+                for item in response.data or [] if item.b64_json is not None]
+    if provider == "google":
+        response = client_googleai.models.generate_images( #pylint: disable=E0606
+            model=model,
+            prompt=prompt,
+            config=GenerateImagesConfig(number_of_images=n),
+        )
+        return [(generated.image.image_bytes, None)
+                for generated in response.generated_images or []
+                if isinstance(generated.image, Image) and generated.image.image_bytes]
+    if provider == "xai":
+        responses = client_xai.image.sample_batch( #pylint: disable=E0606
+            model=model,
+            prompt=prompt,
+            n=n,
+            image_format="base64",
+        )
+        return [(response.image, response.prompt) for response in responses]
+    return []
+
+def send_images(bot, chat_id, images) -> None:
+    """
+    Отправляет изображения группами до MEDIA_GROUP_MAX штук,
+    оставшееся без пары изображение - отдельным фото.
+    """
+    for start in range(0, len(images), MEDIA_GROUP_MAX):
+        batch = images[start:start + MEDIA_GROUP_MAX]
+        if len(batch) == 1:
+            photo, caption = batch[0]
+            send_scheduler.send_photo(bot, chat_id=chat_id, photo=photo,
+                                      caption=caption[:CAPTION_MAX] if caption else None)
+            continue
+        media = [InputMediaPhoto(media=photo,
+                                 caption=caption[:CAPTION_MAX] if caption and i == 0 else None)
+                 for i, (photo, caption) in enumerate(batch)]
+        send_scheduler.send_media_group(bot, chat_id=chat_id, media=media)
+
+def generate_image(update, context):
+    """
+    Функция для генерации изображений по текстовому запросу.
+    Принимает количество изображений (n:) и список моделей (model:), по умолчанию
+    одно изображение моделью dall-e-2. Запросы к моделям выполняются параллельно,
+    готовые изображения накапливаются и отправляются группами по мере готовности.
+    """
+    chat_id = update.effective_chat.id
+    models, count, prompt = parse_image_command(update.message.text[7:])
+    if not bool(prompt):
+        send_scheduler.send_message(
+            context.bot,
+            chat_id=chat_id,
+            text="Промпт не может быть пустым",
+            parse_mode=ParseMode.MARKDOWN,
+        )
+        return
+    if any(model not in IMAGE_MODELS for model in models):
+        send_scheduler.send_message(
+            context.bot,
+            chat_id=chat_id,
             text="Выбранная модель генерации изображений не поддерживается",
             parse_mode=ParseMode.MARKDOWN,
         )
         return
-    else:
-        context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Промпт не может быть пустым",
+    if count < 1 or count * len(models) > MEDIA_GROUP_MAX:
+        send_scheduler.send_message(
+            context.bot,
+            chat_id=chat_id,
+            text=f"Можно сгенерировать от 1 до {MEDIA_GROUP_MAX} изображений за раз",
             parse_mode=ParseMode.MARKDOWN,
         )
         return
+    tasks = image_tasks(models, count)
+    # Каждый запрос к поставщику списывает токен из его корзины,
+    # корзины чата и бота списываются один раз на команду
+    costs = {}
+    for model, _ in tasks:
+        provider = IMAGE_MODELS[model][0]
+        costs[provider] = costs.get(provider, 0) + 1
+    try:
+        rate_limiter.admit(chat_id, costs)
+    except RateLimitExceeded as e:
+        send_scheduler.send_message(context.bot, chat_id=chat_id, text=rate_limit_message(e))
+        return
+    with keep_chat_action(context.bot, chat_id, ChatAction.UPLOAD_PHOTO), \
+            ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+        futures = {executor.submit(generate_images, model, prompt, n): (model, n)
+                   for model, n in tasks}
+        pending = []
+        # Сколько изображений ещё должны вернуть незавершённые запросы
+        remaining = sum(n for _, n in tasks)
+        for future in as_completed(futures):
+            model, n = futures[future]
+            remaining -= n
+            try:
+                images = future.result()
+                if not images:
+                    raise ValueError("empty response")
+                pending.extend(images)
+            except Exception as e: #pylint: disable=W0718
+                logger.error(f"Error generate image from {model}: {str(e)}")
+                send_scheduler.send_message(
+                    context.bot,
+                    chat_id=chat_id,
+                    text=f"Ошибка при генерации изображения моделью {model}: `{str(e)}`",
+                    parse_mode=ParseMode.MARKDOWN,
+                )
+            # Группа отправляется, когда в ней хотя бы два изображения и после неё
+            # не останется одно изображение, которому придётся уйти отдельным фото
+            if len(pending) >= 2 and remaining != 1:
+                send_images(context.bot, chat_id, pending)
+                pending = []
+        if pending:
+            send_images(context.bot, chat_id, pending)
 
+@rate_limited
 @send_typing_action
 def unknown_command(update, context):
     """
@@ -459,7 +1213,8 @@ def unknown_command(update, context):
     Отправляет сообщение о том, что команда не распознана.
     """
     logger.warning(f"Unknown command: {update.message.text}")
-    context.bot.send_message(
+    send_scheduler.send_message(
+        context.bot,
         chat_id=update.message.chat_id,
         text="Команда нераспознана",
         parse_mode=ParseMode.MARKDOWN,
@@ -470,7 +1225,22 @@ def process_voice_message(update, context):
     """
     Функция для обработки голосовых сообщений.
     Загружает голосовое сообщение, генерирует его транскрипцию и отправляет ответ пользователю.
+    Распознавание и синтез речи выполняет OpenAI, ответ - поставщик выбранной модели,
+    поэтому запрос проходит ограничитель частоты запросов один раз до распознавания
+    и списывает токены из корзин обоих поставщиков.
     """
+    chat_id = update.message.chat_id
+    model, _ = load_models_and_msgs(chat_id)
+    # Два запроса к OpenAI (распознавание и синтез речи) и один к поставщику модели
+    costs = {"openai": 2}
+    provider = model_provider(model)
+    if provider is not None:
+        costs[provider] = costs.get(provider, 0) + 1
+    try:
+        rate_limiter.admit(chat_id, costs)
+    except RateLimitExceeded as e:
+        send_scheduler.send_message(context.bot, chat_id=chat_id, text=rate_limit_message(e))
+        return
     # Get the voice message from the update object
     voice_message = update.message.voice
     file_id = voice_message.file_id
@@ -484,14 +1254,14 @@ def process_voice_message(update, context):
         file=downloaded_file,
     )
 
-    chat_id = update.message.chat_id
-    context.bot.send_message(
+    send_scheduler.send_message(
+        context.bot,
         chat_id=chat_id,
         text=f'Распознанное сообщение:\n{transcript_msg.text}',
         parse_mode=ParseMode.MARKDOWN,
     )
 
-    message = ask_neural(transcript_msg.text, update.message.chat_id)
+    message = ask_neural(transcript_msg.text, chat_id, admit=False)
 
     speech_file_path = "/tmp/voice_answer.ogg"
     with client.audio.speech.with_streaming_response.create(
@@ -504,13 +1274,12 @@ def process_voice_message(update, context):
             for chunk in streaming_response.iter_bytes():
                 f.write(chunk)
 
+    # Файл читается целиком, чтобы повторная отправка после RetryAfter не получила пустой поток
     with open(speech_file_path, 'rb') as audio_file:
-        context.bot.send_voice(
-            chat_id=chat_id,
-            voice=audio_file,
-        )
+        send_scheduler.send_voice(context.bot, chat_id=chat_id, voice=audio_file.read())
 
-    context.bot.send_message(
+    send_scheduler.send_message(
+        context.bot,
         chat_id=chat_id,
         text=f'Ответ :\n{message}',
         parse_mode=ParseMode.MARKDOWN,
@@ -531,14 +1300,21 @@ def process_message(update, context):
             keyboard = [[InlineKeyboardButton("Да", callback_data="1"),
                          InlineKeyboardButton("Нет", callback_data="0")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            update.message.reply_text('Вы очень долго не общались с ботом, начать новую сессию?',
-                                      reply_markup=reply_markup)
+            send_scheduler.send_message(
+                context.bot,
+                chat_id=chat_id,
+                text='Вы очень долго не общались с ботом, начать новую сессию?',
+                reply_markup=reply_markup,
+            )
             context.user_data['previous_message_text'] = update.message.text
             return
     try:
         message = ask_neural(chat_text, chat_id)
+    except RateLimitExceeded as e:
+        send_scheduler.send_message(context.bot, chat_id=chat_id, text=rate_limit_message(e))
     except Exception as e: #pylint: disable=W0718
-        context.bot.send_message(
+        send_scheduler.send_message(
+            context.bot,
             chat_id=chat_id,
             text=f"Ошибка при обработке сообщения: `{str(e)}`",
             parse_mode=ParseMode.MARKDOWN,
@@ -547,14 +1323,15 @@ def process_message(update, context):
         try:
             chunks = split_markdown_message_safe(message)
             #logger.info(f"Response: {chunks}")
-            for chunk in chunks:
-                context.bot.send_message(
-                    chat_id=chat_id,
-                    text=chunk,
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
+            send_scheduler.send_chunks(
+                context.bot,
+                chat_id=chat_id,
+                chunks=chunks,
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
         except Exception as e: #pylint: disable=W0718
-            context.bot.send_message(
+            send_scheduler.send_message(
+                context.bot,
                 chat_id=chat_id,
                 text=f"Ошибка при отправке сообщения: `{str(e)}`",
                 parse_mode=ParseMode.MARKDOWN,
@@ -582,10 +1359,14 @@ def handle_photo(update, context):
     caption = update.message.caption or "Опиши это изображение."
 
     # Загружаем предыдущую историю сообщений
-    model, msgs = load_models_and_msgs(effective_user)
+    model, msgs, chat_context = load_chat_record(effective_user)
 
     # Используем только это сообщение для текущего запроса
     try:
+        # gpt-3.5-turbo и неизвестные модели изображения не обрабатывают, токены не нужны
+        provider = None if model == "gpt-3.5-turbo" else model_provider(model)
+        if provider is not None:
+            rate_limiter.admit(chat_id, provider)
         if model in allowed_models_antropic:
             # Создаем мультимодальное сообщение
             current_msg = {
@@ -610,13 +1391,14 @@ def handle_photo(update, context):
             chat = client_anthropic.messages.create(
                 model=model,
                 max_tokens=2000,
-                messages=msgs
+                messages=anthropic_messages(msgs)
             )
             if isinstance(chat.content[0], TextBlock):
                 message = chat.content[0].text
                 msgs.append({"role": "assistant", "content": message})
-                save_file(model, msgs, effective_user)
-                context.bot.send_message(
+                save_without_context(model, msgs, effective_user, chat_context)
+                send_scheduler.send_message(
+                    context.bot,
                     chat_id=chat_id,
                     text=message,
                     parse_mode=ParseMode.MARKDOWN,
@@ -649,14 +1431,16 @@ def handle_photo(update, context):
                 # Сохраняем в историю текстовое представление запроса и ответа
                 msgs.append({"role": "assistant",
                              "content":[{"type": "output_text","text": message}]})
-                save_file(model, msgs, effective_user)
-                context.bot.send_message(
+                save_without_context(model, msgs, effective_user, chat_context)
+                send_scheduler.send_message(
+                    context.bot,
                     chat_id=chat_id,
                     text=message,
                     parse_mode=ParseMode.MARKDOWN,
                 )
             else:
-                context.bot.send_message(
+                send_scheduler.send_message(
+                    context.bot,
                     chat_id=chat_id,
                     text="gpt-3.5-turbo не поддерживает мультимодальность",
                     parse_mode=ParseMode.MARKDOWN,
@@ -674,8 +1458,9 @@ def handle_photo(update, context):
             # Сохраняем в историю текстовое представление запроса и ответа
             msgs.append({"role": "assistant",
                             "content":[{"type": "output_text","text": message}]})
-            save_file(model, msgs, effective_user)
-            context.bot.send_message(
+            save_without_context(model, msgs, effective_user, chat_context)
+            send_scheduler.send_message(
+                context.bot,
                 chat_id=chat_id,
                 text=message,
                 parse_mode=ParseMode.MARKDOWN,
@@ -693,22 +1478,31 @@ def handle_photo(update, context):
             message = response.content
             msgs.append({"role": "assistant",
                 "content":[{"type": "output_text","text": message}]})
-            save_file(model, msgs, effective_user)
-            context.bot.send_message(
+            save_without_context(model, msgs, effective_user, chat_context)
+            send_scheduler.send_message(
+                context.bot,
                 chat_id=chat_id,
                 text=message,
                 parse_mode=ParseMode.MARKDOWN,
             )
             return
-        context.bot.send_message(
+        send_scheduler.send_message(
+            context.bot,
             chat_id=chat_id,
             text="Выбранная вами модель пока поддерживает мультимодальность в боте",
             parse_mode=ParseMode.MARKDOWN,
         )
         return
+    except RateLimitExceeded as e:
+        send_scheduler.send_message(context.bot, chat_id=chat_id, text=rate_limit_message(e))
+        return
     except Exception as e: #pylint: disable=W0718
         logger.error(f"Error processing image: {str(e)}")
-        update.message.reply_text(f"Ошибка при обработке изображения: `{str(e)}`")
+        send_scheduler.send_message(
+            context.bot,
+            chat_id=chat_id,
+            text=f"Ошибка при обработке изображения: `{str(e)}`",
+        )
         return
 
 ############################
@@ -721,6 +1515,7 @@ def message_handler(event):
     Основная функция-обработчик для Lambda, которая принимает события от Telegram.
     Обрабатывает команды и сообщения, отправленные пользователем.
     """
+    send_scheduler.start_request(REQUEST_TIMEOUT)
     dispatcher.add_handler(CommandHandler("new_session",clear_context))
     dispatcher.add_handler(CommandHandler("start",send_greeting))
     dispatcher.add_handler(CommandHandler("help",send_help))
@@ -738,5 +1533,7 @@ def message_handler(event):
     except Exception as e: #pylint: disable=W0718
         logger.error(f"Error processing image: {str(e)}")
         return {"statusCode": 500}
+    finally:
+        run_deferred()
 
     return {"statusCode": 200}
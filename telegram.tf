@@ -13,7 +13,7 @@ resource "telegram_bot_commands" "ai-bot-commands" {
     },
     {
       command = "image",
-      description = "Генерация изображения по текстовому промпту"
+      description = "Генерация изображений: /image [n:2] [model:dall-e-3,grok-2-image] промпт"
     },
     {
       command = "new_session",
@@ -0,0 +1,85 @@
+"""
+Общие фикстуры тестов.
+Модуль main при импорте обращается к Parameter Manager, GCS и API поставщиков,
+поэтому перед импортом клиенты GCP и Gemini/xAI подменяются заглушками.
+"""
+import json
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+ALLOWED_MODELS = {
+    "openai": ["gpt-5-nano"],
+    "antropic": ["claude-sonnet-4-20250514"],
+    "google": ["gemini-2.5-flash"],
+    "xai": ["grok-4"],
+}
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST-TOKEN")
+os.environ.setdefault("CONVERSATION_BUCKET", "test-bucket")
+os.environ.setdefault("GCP_REGION", "europe-west1")
+os.environ.setdefault("GCP_PROJECT", "test-project")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+os.environ.setdefault("XAI_API_KEY", "test")
+
+parameter_client = mock.MagicMock()
+parameter_client.get_parameter_version.return_value.payload.data = json.dumps(
+    ALLOWED_MODELS).encode()
+
+with mock.patch("google.cloud.parametermanager_v1.ParameterManagerClient",
+                return_value=parameter_client), \
+        mock.patch("google.cloud.storage.Client"), \
+        mock.patch("google.genai.Client"), \
+        mock.patch("xai_sdk.Client"):
+    import main  # pylint: disable=wrong-import-position
+
+
+class FakeClock:
+    """
+    Управляемые часы для тестов: sleep сдвигает время вместо ожидания.
+    """
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def chat_store(monkeypatch):
+    """
+    Хранилище записей чатов в памяти вместо GCS.
+    """
+    records = {}
+
+    def load(effective_user):
+        record = records.get(effective_user)
+        if record is None:
+            return "gpt-5-nano", [], {}
+        return (record["model"], json.loads(json.dumps(record["msgs"])),
+                record.get("context", {}))
+
+    def save(model, messages, effective_user, context=None):
+        records[effective_user] = json.loads(json.dumps(
+            {"model": model, "msgs": messages, "context": context or {}}))
+
+    monkeypatch.setattr(main, "load_chat_record", load)
+    monkeypatch.setattr(main, "save_file", save)
+    monkeypatch.setattr(main.rate_limiter, "admit", lambda *args, **kwargs: None)
+    monkeypatch.setattr(main, "DEFERRED_TASKS", [])
+    return records
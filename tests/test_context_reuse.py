@@ -0,0 +1,291 @@
+"""
+Тесты запросов к поставщикам с переиспользованием контекста разговора.
+"""
+from types import SimpleNamespace
+from unittest import mock
+
+import grpc
+import httpx
+import pytest
+from anthropic.types import TextBlock
+from google.genai.errors import ClientError
+from openai import NotFoundError, RateLimitError
+
+import main
+
+
+def openai_error(cls, status):
+    request = httpx.Request("POST", "https://api.openai.com/v1/responses")
+    return cls("error", response=httpx.Response(status, request=request), body=None)
+
+
+class FakeRpcError(grpc.RpcError):
+    def __init__(self, code):
+        super().__init__()
+        self._code = code
+
+    def code(self):
+        return self._code
+
+
+def record(model, msgs, context=None):
+    return {"model": model, "msgs": msgs, "context": context or {}}
+
+
+HISTORY = [{"role": "user", "content": "привет"},
+           {"role": "assistant", "content": "здравствуйте"}]
+
+
+@pytest.fixture
+def reuse(monkeypatch):
+    monkeypatch.setattr(main, "provider_context_reuse", True)
+
+
+def test_anthropic_marks_only_last_block_and_keeps_history(chat_store, monkeypatch):
+    stub = mock.MagicMock()
+    stub.messages.create.return_value = SimpleNamespace(
+        content=[TextBlock(type="text", text="ответ")])
+    monkeypatch.setattr(main, "client_anthropic", stub)
+    chat_store[1] = record("claude-sonnet-4-20250514", HISTORY)
+
+    assert main.ask_neural("вопрос", 1) == "ответ"
+
+    messages = stub.messages.create.call_args.kwargs["messages"]
+    assert messages[:-1] == HISTORY
+    assert messages[-1]["content"] == [{"type": "text", "text": "вопрос",
+                                        "cache_control": {"type": "ephemeral"}}]
+    assert chat_store[1]["msgs"] == HISTORY + [{"role": "user", "content": "вопрос"},
+                                               {"role": "assistant", "content": "ответ"}]
+
+
+def test_anthropic_breakpoint_on_multimodal_message_does_not_touch_history():
+    msgs = [{"role": "user", "content": [{"type": "image", "source": {}},
+                                         {"type": "text", "text": "что это?"}]}]
+    messages = main.anthropic_messages(msgs)
+    assert "cache_control" not in messages[0]["content"][0]
+    assert messages[0]["content"][1]["cache_control"] == {"type": "ephemeral"}
+    assert "cache_control" not in msgs[0]["content"][1]
+
+
+def test_openai_chains_previous_response(chat_store, monkeypatch, reuse):
+    stub = mock.MagicMock()
+    stub.responses.create.return_value = SimpleNamespace(id="resp-2", output_text="ок")
+    monkeypatch.setattr(main, "client", stub)
+    chat_store[1] = record("gpt-5-nano", HISTORY,
+                           {"model": "gpt-5-nano", "response_id": "resp-1"})
+
+    assert main.ask_neural("вопрос", 1) == "ок"
+
+    stub.responses.create.assert_called_once()
+    kwargs = stub.responses.create.call_args.kwargs
+    assert kwargs["previous_response_id"] == "resp-1"
+    assert kwargs["input"] == [{"role": "user",
+                                "content": [{"type": "input_text", "text": "вопрос"}]}]
+    assert chat_store[1]["context"] == {"model": "gpt-5-nano", "response_id": "resp-2"}
+
+
+def test_openai_falls_back_to_full_history_when_response_not_found(chat_store, monkeypatch,
+                                                                   reuse):
+    stub = mock.MagicMock()
+    stub.responses.create.side_effect = [
+        openai_error(NotFoundError, 404),
+        SimpleNamespace(id="resp-2", output_text="ок"),
+    ]
+    monkeypatch.setattr(main, "client", stub)
+    chat_store[1] = record("gpt-5-nano", HISTORY,
+                           {"model": "gpt-5-nano", "response_id": "resp-1"})
+
+    main.ask_neural("вопрос", 1)
+
+    retry = stub.responses.create.call_args_list[1].kwargs
+    assert "previous_response_id" not in retry
+    assert [item["role"] for item in retry["input"]] == ["user", "assistant", "user"]
+
+
+def test_openai_does_not_resend_history_on_other_errors(chat_store, monkeypatch, reuse):
+    stub = mock.MagicMock()
+    stub.responses.create.side_effect = openai_error(RateLimitError, 429)
+    monkeypatch.setattr(main, "client", stub)
+    chat_store[1] = record("gpt-5-nano", HISTORY,
+                           {"model": "gpt-5-nano", "response_id": "resp-1"})
+
+    with pytest.raises(RateLimitError):
+        main.ask_neural("вопрос", 1)
+    stub.responses.create.assert_called_once()
+
+
+def test_context_is_reset_after_model_switch(chat_store, monkeypatch, reuse):
+    stub = mock.MagicMock()
+    stub.responses.create.return_value = SimpleNamespace(id="resp-2", output_text="ок")
+    monkeypatch.setattr(main, "client", stub)
+    chat_store[1] = record("gpt-5-nano", HISTORY, {"model": "grok-4", "response_id": "xai-1"})
+
+    main.ask_neural("вопрос", 1)
+
+    kwargs = stub.responses.create.call_args.kwargs
+    assert "previous_response_id" not in kwargs
+    assert len(kwargs["input"]) == 3
+
+
+def test_context_is_ignored_when_reuse_is_disabled(chat_store, monkeypatch):
+    stub = mock.MagicMock()
+    stub.responses.create.return_value = SimpleNamespace(id="resp-2", output_text="ок")
+    monkeypatch.setattr(main, "client", stub)
+    chat_store[1] = record("gpt-5-nano", HISTORY,
+                           {"model": "gpt-5-nano", "response_id": "resp-1"})
+
+    main.ask_neural("вопрос", 1)
+
+    assert "previous_response_id" not in stub.responses.create.call_args.kwargs
+    assert chat_store[1]["context"] == {}
+
+
+def test_gemini_sends_uncached_tail_with_cache(chat_store, monkeypatch, reuse):
+    stub = mock.MagicMock()
+    stub.models.generate_content.return_value = SimpleNamespace(text="ок")
+    monkeypatch.setattr(main, "client_googleai", stub)
+    chat_store[1] = record("gemini-2.5-flash", HISTORY,
+                           {"model": "gemini-2.5-flash", "cache": {"name": "c1", "count": 2}})
+
+    main.ask_neural("вопрос", 1)
+
+    kwargs = stub.models.generate_content.call_args.kwargs
+    assert kwargs["config"].cached_content == "c1"
+    assert [content.parts[0].text for content in kwargs["contents"]] == ["вопрос"]
+    stub.caches.create.assert_not_called()
+    assert chat_store[1]["context"]["cache"] == {"name": "c1", "count": 2}
+
+
+def test_gemini_falls_back_only_when_cache_not_found(chat_store, monkeypatch, reuse):
+    stub = mock.MagicMock()
+    stub.models.generate_content.side_effect = [ClientError(404, {}),
+                                                SimpleNamespace(text="ок")]
+    monkeypatch.setattr(main, "client_googleai", stub)
+    chat_store[1] = record("gemini-2.5-flash", HISTORY,
+                           {"model": "gemini-2.5-flash", "cache": {"name": "c1", "count": 2}})
+
+    main.ask_neural("вопрос", 1)
+
+    retry = stub.models.generate_content.call_args_list[1].kwargs
+    assert "config" not in retry
+    assert len(retry["contents"]) == 3
+
+    stub.models.generate_content.reset_mock()
+    stub.models.generate_content.side_effect = ClientError(429, {})
+    chat_store[1]["context"] = {"model": "gemini-2.5-flash",
+                                "cache": {"name": "c1", "count": 2}}
+    with pytest.raises(ClientError):
+        main.ask_neural("вопрос", 1)
+    stub.models.generate_content.assert_called_once()
+
+
+def test_gemini_cache_is_refreshed_after_reply(chat_store, monkeypatch, reuse):
+    stub = mock.MagicMock()
+    stub.models.generate_content.return_value = SimpleNamespace(text="ок")
+    stub.caches.create.return_value = SimpleNamespace(name="c2")
+    monkeypatch.setattr(main, "client_googleai", stub)
+    chat_store[1] = record("gemini-2.5-flash", HISTORY,
+                           {"model": "gemini-2.5-flash", "cache": {"name": "c1", "count": 2}})
+
+    main.ask_neural("x" * main.GEMINI_CACHE_MIN_CHARS, 1)
+
+    stub.caches.create.assert_not_called()
+    assert chat_store[1]["context"]["cache"] == {"name": "c1", "count": 2}
+    main.run_deferred()
+    stub.caches.delete.assert_called_once_with(name="c1")
+    assert chat_store[1]["context"]["cache"] == {"name": "c2", "count": 4}
+
+
+def command_update(text):
+    update = mock.MagicMock()
+    update.message.chat_id = 1
+    update.message.text = text
+    return update
+
+
+@pytest.mark.parametrize("handler, text", [
+    (main.set_model, "/set_model gpt-5-nano"),
+    (main.clear_context, "/new_session"),
+])
+def test_dropped_context_deletes_gemini_cache(chat_store, monkeypatch, handler, text):
+    stub = mock.MagicMock()
+    monkeypatch.setattr(main, "client_googleai", stub)
+    monkeypatch.setattr(main, "send_scheduler", mock.MagicMock())
+    chat_store[1] = record("gemini-2.5-flash", HISTORY,
+                           {"model": "gemini-2.5-flash", "cache": {"name": "c1", "count": 2}})
+
+    handler(command_update(text), mock.MagicMock())
+
+    assert chat_store[1]["context"] == {}
+    main.run_deferred()
+    stub.caches.delete.assert_called_once_with(name="c1")
+
+
+def test_model_switch_deletes_gemini_cache(chat_store, monkeypatch, reuse):
+    stub = mock.MagicMock()
+    stub.responses.create.return_value = SimpleNamespace(id="resp-1", output_text="ок")
+    monkeypatch.setattr(main, "client", stub)
+    monkeypatch.setattr(main, "client_googleai", mock.MagicMock())
+    chat_store[1] = record("gpt-5-nano", HISTORY,
+                           {"model": "gemini-2.5-flash", "cache": {"name": "c1", "count": 2}})
+
+    main.ask_neural("вопрос", 1)
+    main.run_deferred()
+
+    main.client_googleai.caches.delete.assert_called_once_with(name="c1")
+
+
+def test_refresh_gemini_cache_respects_threshold(monkeypatch):
+    stub = mock.MagicMock()
+    stub.caches.create.return_value = SimpleNamespace(name="c2")
+    monkeypatch.setattr(main, "client_googleai", stub)
+    cache = {"name": "c1", "count": 2}
+    short = HISTORY + [{"role": "user", "content": "x" * 100}]
+
+    assert main.refresh_gemini_cache("gemini-2.5-flash", short, cache) == cache
+    stub.caches.create.assert_not_called()
+
+    long = HISTORY + [{"role": "user", "content": "x" * main.GEMINI_CACHE_MIN_CHARS}]
+    assert main.refresh_gemini_cache("gemini-2.5-flash", long, cache) == {"name": "c2",
+                                                                           "count": 3}
+    assert len(stub.caches.create.call_args.kwargs["config"].contents) == 3
+    stub.caches.delete.assert_called_once_with(name="c1")
+
+
+def test_xai_chains_previous_response(chat_store, monkeypatch, reuse):
+    stub = mock.MagicMock()
+    stub.chat.create.return_value.sample.return_value = SimpleNamespace(id="x-2", content="ок")
+    monkeypatch.setattr(main, "client_xai", stub)
+    chat_store[1] = record("grok-4", HISTORY, {"model": "grok-4", "response_id": "x-1"})
+
+    main.ask_neural("вопрос", 1)
+
+    kwargs = stub.chat.create.call_args.kwargs
+    assert kwargs["previous_response_id"] == "x-1"
+    assert kwargs["store_messages"] is True
+    assert len(kwargs["messages"]) == 1
+    assert chat_store[1]["context"] == {"model": "grok-4", "response_id": "x-2"}
+
+
+@pytest.mark.parametrize("code, retried", [
+    (grpc.StatusCode.NOT_FOUND, True),
+    (grpc.StatusCode.INVALID_ARGUMENT, True),
+    (grpc.StatusCode.RESOURCE_EXHAUSTED, False),
+    (grpc.StatusCode.UNAVAILABLE, False),
+])
+def test_xai_falls_back_only_for_missing_response(chat_store, monkeypatch, reuse, code,
+                                                  retried):
+    stub = mock.MagicMock()
+    stub.chat.create.return_value.sample.side_effect = [
+        FakeRpcError(code), SimpleNamespace(id="x-2", content="ок")]
+    monkeypatch.setattr(main, "client_xai", stub)
+    chat_store[1] = record("grok-4", HISTORY, {"model": "grok-4", "response_id": "x-1"})
+
+    if retried:
+        main.ask_neural("вопрос", 1)
+        assert len(stub.chat.create.call_args.kwargs["messages"]) == 3
+        assert "previous_response_id" not in stub.chat.create.call_args.kwargs
+    else:
+        with pytest.raises(grpc.RpcError):
+            main.ask_neural("вопрос", 1)
+        stub.chat.create.assert_called_once()
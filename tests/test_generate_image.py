@@ -0,0 +1,171 @@
+"""
+Тесты команды /image: разбор аргументов, разбиение на запросы и отправка изображений.
+"""
+from unittest import mock
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("text, models, count, prompt", [
+    ("кот в шляпе", ["dall-e-2"], 1, "кот в шляпе"),
+    ("model:dall-e-3 кот в шляпе", ["dall-e-3"], 1, "кот в шляпе"),
+    ("n:3 кот", ["dall-e-2"], 3, "кот"),
+    ("n:2 model:dall-e-3,grok-2-image кот", ["dall-e-3", "grok-2-image"], 2, "кот"),
+    ("model:dall-e-3,grok-2-image n:2 кот", ["dall-e-3", "grok-2-image"], 2, "кот"),
+    ("model:dall-e-3 model:grok-2-image кот", ["dall-e-3", "grok-2-image"], 1, "кот"),
+    ("n:0 кот", ["dall-e-2"], 0, "кот"),
+    ("model:unknown кот", ["unknown"], 1, "кот"),
+    ("model:dall-e-3", ["dall-e-3"], 1, ""),
+    ("", ["dall-e-2"], 1, ""),
+    ("кот\nn:2 в шляпе", ["dall-e-2"], 1, "кот\nn:2 в шляпе"),
+])
+def test_parse_image_command(text, models, count, prompt):
+    assert main.parse_image_command(text) == (models, count, prompt)
+
+
+@pytest.mark.parametrize("models, count, tasks", [
+    (["dall-e-2"], 3, [("dall-e-2", 3)]),
+    (["dall-e-3"], 3, [("dall-e-3", 1)] * 3),
+    (["imagen-4.0-generate-001"], 5,
+     [("imagen-4.0-generate-001", 4), ("imagen-4.0-generate-001", 1)]),
+    (["grok-2-image", "dall-e-3"], 2, [("grok-2-image", 2), ("dall-e-3", 1), ("dall-e-3", 1)]),
+])
+def test_image_tasks(models, count, tasks):
+    assert main.image_tasks(models, count) == tasks
+
+
+def test_send_images_sends_single_photo(monkeypatch):
+    scheduler = mock.MagicMock()
+    monkeypatch.setattr(main, "send_scheduler", scheduler)
+    main.send_images("bot", 1, [(b"image", "x" * 2000)])
+    scheduler.send_photo.assert_called_once_with("bot", chat_id=1, photo=b"image",
+                                                 caption="x" * main.CAPTION_MAX)
+    scheduler.send_media_group.assert_not_called()
+
+
+def test_send_images_sends_media_group_with_first_caption(monkeypatch):
+    scheduler = mock.MagicMock()
+    monkeypatch.setattr(main, "send_scheduler", scheduler)
+    main.send_images("bot", 1, [(b"one", "первое"), (b"two", "второе")])
+    scheduler.send_photo.assert_not_called()
+    media = scheduler.send_media_group.call_args.kwargs["media"]
+    assert [getattr(item, "caption", None) for item in media] == ["первое", None]
+
+
+def image_update(text):
+    update = mock.MagicMock()
+    update.effective_chat.id = 1
+    update.message.text = text
+    return update
+
+
+@pytest.fixture
+def limiter(monkeypatch, clock):
+    limiter = main.RateLimiter.from_config({
+        "chat": {"rate": 1.0, "burst": 5},
+        "global": {"rate": 10.0, "burst": 10},
+        "providers": {"openai": {"rate": 1.0, "burst": 10}, "xai": {"rate": 1.0, "burst": 1}},
+        "max_wait": {main.PRIORITY_LLM: 0.0},
+        "command_reserve": 0,
+    }, clock=clock, sleep=clock.sleep)
+    monkeypatch.setattr(main, "rate_limiter", limiter)
+    return limiter
+
+
+def provider_tokens(limiter, provider):
+    return limiter.local_store._buckets[f"provider-{provider}"]["tokens"]  # pylint: disable=protected-access
+
+
+def chat_tokens(limiter):
+    return limiter.store._buckets["chat-1"]["tokens"]  # pylint: disable=protected-access
+
+
+def test_send_images_splits_into_media_groups(monkeypatch):
+    scheduler = mock.MagicMock()
+    monkeypatch.setattr(main, "send_scheduler", scheduler)
+    main.send_images("bot", 1, [(b"image", None)] * (main.MEDIA_GROUP_MAX + 1))
+    assert len(scheduler.send_media_group.call_args.kwargs["media"]) == main.MEDIA_GROUP_MAX
+    scheduler.send_photo.assert_called_once()
+
+
+def test_generate_image_charges_provider_per_request(monkeypatch, limiter):
+    monkeypatch.setattr(main, "generate_images", lambda model, prompt, n: [(b"image", None)] * n)
+    scheduler = mock.MagicMock()
+    monkeypatch.setattr(main, "send_scheduler", scheduler)
+
+    main.generate_image(image_update("/image n:3 model:dall-e-3 кот"), mock.MagicMock())
+
+    assert provider_tokens(limiter, "openai") == pytest.approx(7.0)
+    assert chat_tokens(limiter) == pytest.approx(4.0)
+    # Три запроса dall-e-3 уходят пользователю одной группой, а не тремя фото
+    scheduler.send_photo.assert_not_called()
+    assert sum(len(call.kwargs["media"])
+               for call in scheduler.send_media_group.call_args_list) == 3
+
+
+def test_generate_image_admits_several_providers_once(monkeypatch, limiter):
+    monkeypatch.setattr(main, "generate_images", lambda model, prompt, n: [(b"image", None)] * n)
+    scheduler = mock.MagicMock()
+    monkeypatch.setattr(main, "send_scheduler", scheduler)
+
+    main.generate_image(image_update("/image model:dall-e-2,dall-e-3,grok-2-image кот"),
+                        mock.MagicMock())
+
+    assert chat_tokens(limiter) == pytest.approx(4.0)
+    assert limiter.local_store._buckets["global"]["tokens"] == pytest.approx(9.0)  # pylint: disable=protected-access
+    assert provider_tokens(limiter, "openai") == pytest.approx(8.0)
+    assert provider_tokens(limiter, "xai") == pytest.approx(0.0)
+
+
+def test_generate_image_buffers_images_around_failed_request(monkeypatch, limiter):
+    def generate(model, prompt, n):
+        if model == "grok-2-image":
+            raise RuntimeError("boom")
+        return [(b"image", None)] * n
+    monkeypatch.setattr(main, "generate_images", generate)
+    scheduler = mock.MagicMock()
+    monkeypatch.setattr(main, "send_scheduler", scheduler)
+
+    main.generate_image(image_update("/image model:dall-e-3,dall-e-3,grok-2-image кот"),
+                        mock.MagicMock())
+
+    scheduler.send_photo.assert_not_called()
+    scheduler.send_media_group.assert_called_once()
+    assert len(scheduler.send_media_group.call_args.kwargs["media"]) == 2
+    assert "grok-2-image" in scheduler.send_message.call_args.kwargs["text"]
+
+
+def test_generate_image_refunds_admitted_providers(monkeypatch, limiter):
+    generate = mock.MagicMock()
+    monkeypatch.setattr(main, "generate_images", generate)
+    scheduler = mock.MagicMock()
+    monkeypatch.setattr(main, "send_scheduler", scheduler)
+    limiter.admit(2, "xai")
+
+    main.generate_image(image_update("/image n:2 model:dall-e-3,grok-2-image кот"),
+                        mock.MagicMock())
+
+    generate.assert_not_called()
+    assert provider_tokens(limiter, "openai") == pytest.approx(10.0)
+    assert chat_tokens(limiter) == pytest.approx(5.0)
+    assert "Слишком много запросов" in scheduler.send_message.call_args.kwargs["text"]
+
+
+@pytest.mark.parametrize("text, reply", [
+    ("/image n:0 кот", "Можно сгенерировать"),
+    ("/image n:6 model:dall-e-2,grok-2-image кот", "Можно сгенерировать"),
+    ("/image model:unknown кот", "не поддерживается"),
+    ("/image model:dall-e-3", "Промпт не может быть пустым"),
+])
+def test_generate_image_rejects_invalid_commands(monkeypatch, text, reply):
+    generate = mock.MagicMock()
+    monkeypatch.setattr(main, "generate_images", generate)
+    scheduler = mock.MagicMock()
+    monkeypatch.setattr(main, "send_scheduler", scheduler)
+
+    main.generate_image(image_update(text), mock.MagicMock())
+
+    generate.assert_not_called()
+    assert reply in scheduler.send_message.call_args.kwargs["text"]
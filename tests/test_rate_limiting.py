@@ -0,0 +1,261 @@
+"""
+Тесты ограничителя частоты запросов на корзинах токенов.
+"""
+from unittest import mock
+
+import pytest
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+import main
+
+LIMITS = {
+    "backend": "memory",
+    "chat": {"rate": 1.0, "burst": 3},
+    "global": {"rate": 10.0, "burst": 10},
+    "providers": {"openai": {"rate": 0.5, "burst": 2}},
+    "max_wait": {main.PRIORITY_COMMAND: 5.0, main.PRIORITY_LLM: 0.0},
+    "command_reserve": 1,
+}
+
+
+def make_limiter(clock, **overrides):
+    return main.RateLimiter.from_config({**LIMITS, **overrides},
+                                        clock=clock, sleep=clock.sleep)
+
+
+def bucket_tokens(limiter, key):
+    return limiter.local_store._buckets[key]["tokens"]  # pylint: disable=protected-access
+
+
+def test_take_token_starts_full_and_takes_one():
+    state, wait = main.take_token(None, rate=1.0, burst=3, now=0.0)
+    assert wait == 0.0
+    assert state == {"tokens": 2.0, "updated": 0.0}
+
+
+def test_take_token_refills_by_rate_up_to_burst():
+    state, wait = main.take_token({"tokens": 0.0, "updated": 0.0}, rate=0.5, burst=3, now=4.0)
+    assert wait == 0.0
+    assert state["tokens"] == pytest.approx(1.0)
+    state, _ = main.take_token({"tokens": 0.0, "updated": 0.0}, rate=0.5, burst=3, now=100.0)
+    assert state["tokens"] == pytest.approx(2.0)
+
+
+def test_take_token_returns_wait_without_taking():
+    state, wait = main.take_token({"tokens": 0.25, "updated": 0.0}, rate=0.5, burst=3, now=0.0)
+    assert wait == pytest.approx(1.5)
+    assert state["tokens"] == pytest.approx(0.25)
+
+
+def test_take_token_keeps_reserve():
+    state, wait = main.take_token({"tokens": 1.5, "updated": 0.0}, rate=1.0, burst=3, now=0.0,
+                                  reserve=1)
+    assert wait == pytest.approx(0.5)
+    assert state["tokens"] == pytest.approx(1.5)
+
+
+def test_take_token_refund_returns_token_up_to_burst():
+    state, wait = main.take_token({"tokens": 1.0, "updated": 0.0}, rate=1.0, burst=3, now=0.0,
+                                  refund=True)
+    assert wait == 0.0
+    assert state["tokens"] == pytest.approx(2.0)
+    state, _ = main.take_token({"tokens": 3.0, "updated": 0.0}, rate=1.0, burst=3, now=0.0,
+                               refund=True)
+    assert state["tokens"] == pytest.approx(3.0)
+
+
+def test_command_reserve_keeps_last_tokens_for_commands(clock):
+    limiter = make_limiter(clock)
+    limiter.admit(1, priority=main.PRIORITY_LLM)
+    limiter.admit(1, priority=main.PRIORITY_LLM)
+    with pytest.raises(main.RateLimitExceeded) as error:
+        limiter.admit(1, priority=main.PRIORITY_LLM)
+    assert error.value.scope == "chat-1"
+    limiter.admit(1, priority=main.PRIORITY_COMMAND)
+    assert clock.sleeps == []
+
+
+def test_command_waits_within_max_wait(clock):
+    limiter = make_limiter(clock)
+    for _ in range(3):
+        limiter.admit(1, priority=main.PRIORITY_COMMAND)
+    limiter.admit(1, priority=main.PRIORITY_COMMAND)
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_sheds_after_max_wait(clock):
+    limiter = make_limiter(clock, max_wait={main.PRIORITY_COMMAND: 0.5})
+    for _ in range(3):
+        limiter.admit(1, priority=main.PRIORITY_COMMAND)
+    with pytest.raises(main.RateLimitExceeded) as error:
+        limiter.admit(1, priority=main.PRIORITY_COMMAND)
+    assert error.value.retry_after == pytest.approx(1.0)
+    assert clock.sleeps == []
+
+
+def test_refunds_taken_buckets_when_later_bucket_fails(clock):
+    limiter = make_limiter(clock, chat={"rate": 1.0, "burst": 10})
+    limiter.admit(1, "openai")
+    limiter.admit(2, "openai")
+    with pytest.raises(main.RateLimitExceeded) as error:
+        limiter.admit(3, "openai")
+    assert error.value.scope == "provider-openai"
+    # Токен корзины чата возвращён, до общей корзины очередь не дошла
+    assert limiter.store._buckets["chat-3"]["tokens"] == pytest.approx(10.0)  # pylint: disable=protected-access
+    assert bucket_tokens(limiter, "global") == pytest.approx(8.0)
+
+
+def test_zero_rate_buckets_are_disabled(clock):
+    limiter = make_limiter(clock, chat={"rate": 0, "burst": 0},
+                           providers={"openai": {"rate": 0, "burst": 0}})
+    # Без корзин чата и поставщика запросы ограничивает только общая корзина
+    for _ in range(9):
+        limiter.admit(1, "openai")
+    assert "chat-1" not in limiter.store._buckets  # pylint: disable=protected-access
+    assert "provider-openai" not in limiter.local_store._buckets  # pylint: disable=protected-access
+
+
+def test_gcs_backend_stores_only_chat_buckets(clock):
+    store = mock.MagicMock()
+    store.update.side_effect = lambda key, func: func(None)[1]
+    limiter = main.RateLimiter(main.RateLimiter.from_config(LIMITS).limits, store,
+                               clock=clock, sleep=clock.sleep)
+    limiter.admit(1, "openai")
+    assert [call.args[0] for call in store.update.call_args_list] == ["chat-1"]
+    assert set(limiter.local_store._buckets) == {"provider-openai", "global"}  # pylint: disable=protected-access
+
+
+def test_store_failure_falls_back_to_memory_and_logs_error_once(clock):
+    store = mock.MagicMock()
+    store.update.side_effect = RuntimeError("gcs down")
+    limiter = main.RateLimiter(main.RateLimiter.from_config(LIMITS).limits, store,
+                               clock=clock, sleep=clock.sleep)
+    with mock.patch.object(main, "logger") as logger:
+        limiter.admit(1, priority=main.PRIORITY_COMMAND)
+        limiter.admit(1, priority=main.PRIORITY_COMMAND)
+    assert logger.error.call_count == 1
+    assert logger.warning.call_count == 1
+    assert "chat-1" in limiter.local_store._buckets  # pylint: disable=protected-access
+
+
+def gcs_blob(monkeypatch):
+    blob = mock.MagicMock()
+    monkeypatch.setattr(main, "storage_client", mock.MagicMock())
+    main.storage_client.bucket.return_value.blob.return_value = blob
+    return blob
+
+
+def test_gcs_store_creates_missing_object(monkeypatch):
+    blob = gcs_blob(monkeypatch)
+    blob.download_as_bytes.side_effect = NotFound("missing")
+    result = main.GcsBucketStore("bucket").update("chat-1", lambda state: ({"n": 1}, state))
+    assert result is None
+    assert blob.upload_from_string.call_args.kwargs["if_generation_match"] == 0
+    blob.reload.assert_not_called()
+
+
+def test_gcs_store_retries_on_concurrent_write(monkeypatch):
+    blob = gcs_blob(monkeypatch)
+    blob.download_as_bytes.side_effect = [b'{"n": 1}', b'{"n": 2}']
+    blob.generation = 7
+    blob.upload_from_string.side_effect = [PreconditionFailed("changed"), None]
+    result = main.GcsBucketStore("bucket").update(
+        "chat-1", lambda state: ({"n": state["n"] + 1}, state["n"]))
+    assert result == 2
+    assert blob.upload_from_string.call_args.kwargs["if_generation_match"] == 7
+
+
+def test_gcs_store_retries_when_read_precondition_fails(monkeypatch):
+    blob = gcs_blob(monkeypatch)
+    blob.download_as_bytes.side_effect = [PreconditionFailed("changed"), b'{"n": 1}']
+    blob.generation = 3
+    result = main.GcsBucketStore("bucket").update("chat-1", lambda state: (state, state["n"]))
+    assert result == 1
+
+
+def test_admit_charges_cost_to_provider_bucket_only(clock):
+    limiter = make_limiter(clock, providers={"openai": {"rate": 1.0, "burst": 5}})
+    limiter.admit(1, {"openai": 3})
+    assert bucket_tokens(limiter, "provider-openai") == pytest.approx(2.0)
+    assert limiter.store._buckets["chat-1"]["tokens"] == pytest.approx(2.0)  # pylint: disable=protected-access
+
+
+def test_admit_sheds_cost_above_burst_and_refunds(clock):
+    limiter = make_limiter(clock, chat={"rate": 1.0, "burst": 10})
+    with pytest.raises(main.RateLimitExceeded) as error:
+        limiter.admit(1, {"openai": 3})
+    assert error.value.scope == "provider-openai"
+    assert limiter.store._buckets["chat-1"]["tokens"] == pytest.approx(10.0)  # pylint: disable=protected-access
+    assert clock.sleeps == []
+
+
+def test_refund_returns_admitted_tokens(clock):
+    limiter = make_limiter(clock, chat={"rate": 1.0, "burst": 10},
+                           providers={"openai": {"rate": 1.0, "burst": 5}})
+    limiter.admit(1, {"openai": 4})
+    limiter.refund(1, {"openai": 4})
+    assert bucket_tokens(limiter, "provider-openai") == pytest.approx(5.0)
+    assert bucket_tokens(limiter, "global") == pytest.approx(10.0)
+    assert limiter.store._buckets["chat-1"]["tokens"] == pytest.approx(10.0)  # pylint: disable=protected-access
+
+
+def test_admit_charges_chat_and_global_once_for_several_providers(clock):
+    limiter = make_limiter(clock, providers={"openai": {"rate": 1.0, "burst": 5},
+                                             "xai": {"rate": 1.0, "burst": 5}})
+    limiter.admit(1, {"openai": 2, "xai": 3})
+    assert limiter.store._buckets["chat-1"]["tokens"] == pytest.approx(2.0)  # pylint: disable=protected-access
+    assert bucket_tokens(limiter, "global") == pytest.approx(9.0)
+    assert bucket_tokens(limiter, "provider-openai") == pytest.approx(3.0)
+    assert bucket_tokens(limiter, "provider-xai") == pytest.approx(2.0)
+
+
+def test_admit_refunds_every_provider_when_one_is_shed(clock):
+    limiter = make_limiter(clock, providers={"openai": {"rate": 1.0, "burst": 5},
+                                             "xai": {"rate": 1.0, "burst": 1}})
+    with pytest.raises(main.RateLimitExceeded) as error:
+        limiter.admit(1, {"openai": 2, "xai": 2})
+    assert error.value.scope == "provider-xai"
+    assert bucket_tokens(limiter, "provider-openai") == pytest.approx(5.0)
+    assert limiter.store._buckets["chat-1"]["tokens"] == pytest.approx(3.0)  # pylint: disable=protected-access
+
+
+def test_voice_message_charges_openai_and_model_provider(chat_store, monkeypatch):
+    chat_store[1] = {"model": "claude-sonnet-4-20250514", "msgs": []}
+    limiter = mock.MagicMock()
+    limiter.admit.side_effect = main.RateLimitExceeded("provider-antropic", 1.0)
+    monkeypatch.setattr(main, "rate_limiter", limiter)
+    monkeypatch.setattr(main, "send_scheduler", mock.MagicMock())
+    monkeypatch.setattr(main, "client", mock.MagicMock())
+    update = mock.MagicMock()
+    update.message.chat_id = 1
+
+    main.process_voice_message(update, mock.MagicMock())
+
+    limiter.admit.assert_called_once_with(1, {"openai": 2, "antropic": 1})
+    main.client.audio.transcriptions.create.assert_not_called()
+    assert "Слишком много запросов" in main.send_scheduler.send_message.call_args.kwargs["text"]
+
+
+@pytest.mark.parametrize("model, provider", [
+    ("claude-sonnet-4-20250514", "antropic"),
+    ("gpt-3.5-turbo", None),
+    ("unknown", None),
+])
+def test_photo_admits_only_models_that_call_provider(chat_store, monkeypatch, model, provider):
+    chat_store[1] = {"model": model, "msgs": []}
+    limiter = mock.MagicMock()
+    limiter.admit.side_effect = main.RateLimitExceeded("chat-1", 1.0)
+    monkeypatch.setattr(main, "rate_limiter", limiter)
+    monkeypatch.setattr(main, "send_scheduler", mock.MagicMock())
+    monkeypatch.setattr(main.requests, "get", mock.MagicMock())
+    main.requests.get.return_value.content = b"image"
+    update = mock.MagicMock()
+    update.message.from_user.id = 1
+    update.message.chat_id = 1
+
+    main.handle_photo(update, mock.MagicMock())
+
+    if provider is None:
+        limiter.admit.assert_not_called()
+    else:
+        limiter.admit.assert_called_once_with(1, provider)
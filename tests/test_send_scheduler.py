@@ -0,0 +1,113 @@
+"""
+Тесты планировщика исходящих сообщений Telegram.
+"""
+from unittest import mock
+
+import pytest
+from telegram.error import RetryAfter
+
+import main
+
+LIMITS = {
+    "chat": {"rate": 1.0, "burst": 2},
+    "group": {"rate": 20 / 60, "burst": 2},
+    "global": {"rate": 30.0, "burst": 30},
+}
+
+
+@pytest.fixture
+def scheduler(clock):
+    return main.SendScheduler(LIMITS, clock=clock, sleep=clock.sleep)
+
+
+def test_waits_for_chat_bucket(scheduler, clock):
+    bot = mock.MagicMock()
+    for _ in range(3):
+        scheduler.send_message(bot, 1, "текст")
+    assert bot.send_message.call_count == 3
+    assert clock.sleeps == [pytest.approx(1.0)]
+
+
+def test_group_chats_use_group_rate(scheduler, clock):
+    bot = mock.MagicMock()
+    for _ in range(3):
+        scheduler.send_message(bot, -100, "текст")
+    assert clock.sleeps == [pytest.approx(3.0)]
+
+
+def test_retries_after_flood_control(scheduler, clock):
+    bot = mock.MagicMock()
+    bot.send_message.side_effect = [RetryAfter(5), "message"]
+    assert scheduler.send_message(bot, 1, "текст") == "message"
+    assert clock.sleeps == [5]
+
+
+def test_drops_send_when_retry_after_exceeds_deadline(scheduler, clock):
+    bot = mock.MagicMock()
+    bot.send_message.side_effect = RetryAfter(30)
+    scheduler.start_request(10)
+    assert scheduler.send_message(bot, 1, "текст") is None
+    bot.send_message.assert_called_once()
+    assert clock.sleeps == []
+
+
+def test_drops_send_when_bucket_wait_exceeds_deadline(scheduler, clock):
+    bot = mock.MagicMock()
+    scheduler.start_request(2)
+    for _ in range(2):
+        scheduler.send_message(bot, -100, "текст")
+    assert scheduler.send_message(bot, -100, "текст") is None
+    assert bot.send_message.call_count == 2
+    assert clock.sleeps == []
+
+
+def test_send_chunks_stops_after_dropped_chunk(scheduler):
+    bot = mock.MagicMock()
+    bot.send_message.side_effect = ["first", RetryAfter(60), "third"]
+    scheduler.start_request(10)
+    scheduler.send_chunks(bot, 1, ["a", "b", "c"])
+    assert [call.kwargs["text"] for call in bot.send_message.call_args_list] == ["a", "b"]
+
+
+def test_chat_action_does_not_use_chat_bucket(scheduler, clock):
+    bot = mock.MagicMock()
+    for _ in range(5):
+        scheduler.send_chat_action(bot, 1, main.ChatAction.TYPING)
+    scheduler.send_message(bot, 1, "текст")
+    scheduler.send_message(bot, 1, "текст")
+    assert bot.send_chat_action.call_count == 5
+    assert clock.sleeps == []
+
+
+def test_chat_action_is_skipped_when_bot_bucket_is_empty(clock):
+    scheduler = main.SendScheduler({**LIMITS, "global": {"rate": 1.0, "burst": 1}},
+                                   clock=clock, sleep=clock.sleep)
+    bot = mock.MagicMock()
+    scheduler.send_chat_action(bot, 1, main.ChatAction.TYPING)
+    scheduler.send_chat_action(bot, 1, main.ChatAction.TYPING)
+    assert bot.send_chat_action.call_count == 1
+    assert clock.sleeps == []
+
+
+def test_send_voice_retries_after_flood_control(scheduler, clock):
+    bot = mock.MagicMock()
+    bot.send_voice.side_effect = [RetryAfter(2), "voice"]
+    assert scheduler.send_voice(bot, 1, b"ogg") == "voice"
+    assert [call.kwargs["voice"] for call in bot.send_voice.call_args_list] == [b"ogg", b"ogg"]
+    assert clock.sleeps == [2]
+
+
+def test_session_prompt_goes_through_scheduler(monkeypatch):
+    scheduler = mock.MagicMock()
+    monkeypatch.setattr(main, "send_scheduler", scheduler)
+    monkeypatch.setattr(main, "file_exists_in_s3", lambda key: True)
+    monkeypatch.setattr(main, "last_conversation", lambda key: 0.0)
+    update = mock.MagicMock()
+    update.message.chat_id = 1
+
+    main.process_message(update, mock.MagicMock())
+
+    update.message.reply_text.assert_not_called()
+    kwargs = scheduler.send_message.call_args.kwargs
+    assert "новую сессию" in kwargs["text"]
+    assert isinstance(kwargs["reply_markup"], main.InlineKeyboardMarkup)
@@ -40,6 +40,24 @@ variable allowed_models_google {
   description = "List of allowed Google models"
 }
 
+variable rate_limits {
+  type        = any
+  default     = {}
+  description = "Rate limits for chats, providers and the whole bot (token buckets)"
+}
+
+variable provider_context_reuse {
+  type        = bool
+  default     = false
+  description = "Keep conversation state on the provider side (OpenAI/xAI previous_response_id, Gemini context cache)"
+}
+
+variable function_timeout {
+  type        = number
+  default     = 60
+  description = "Cloud Function timeout in seconds, also passed to the function to bound Telegram send waits"
+}
+
 variable telegram_token {
   type        = string
   default     = ""